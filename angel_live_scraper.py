@@ -1,12 +1,48 @@
+import json
 import os
 import re
-from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urljoin, urlsplit
 import requests
 from requests import RequestException
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, NavigableString
+
+from detail_cache import DetailCache
+
+# lxml（C 実装）があれば使い、無ければ標準の html.parser にフォールバック
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# orjson があれば POST 本文のシリアライズに使う
+try:
+    import orjson
+
+    def dump_json(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def dump_json(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
 API_URL = os.environ.get("API_URL")
 API_KEY = os.environ.get("API_KEY")
+# API キーはスクレイピング先に送らないよう、セッション共通ヘッダーではなく POST 時のみ付与する
+API_HEADERS = {"X-API-KEY": API_KEY, "Content-Type": "application/json"}
+
+# 詳細ページ取得・API 送信の同時実行数
+DETAIL_WORKERS = 10
+POST_WORKERS = 8
+
+# 詳細ページの ETag / Last-Modified と解析結果を保存し、次回は条件付き GET で 304 なら再解析しない
+DETAIL_CACHE_PATH = os.environ.get("ANGEL_LIVE_DETAIL_CACHE", "angel_detail_cache.json")
+# parse_detail_page の出力が変わる修正をしたら上げる（古い解析結果のキャッシュを捨てる）
+DETAIL_PARSER_VERSION = 1
 
 DEFAULT_HEADERS = {
     "User-Agent": (
@@ -15,6 +51,12 @@ DEFAULT_HEADERS = {
     )
 }
 
+_BG_URL_RE = re.compile(r"url\((.*?)\)")
+_DIGITS_RE = re.compile(r"(\d+)")
+_NAME_CLEAN_RE = re.compile(r"[^\w\sぁ-ゟ゠-ヿ一-龥々ー０-９Ａ-Ｚａ-ｚー-]+")
+_NAME_AGE_RE = re.compile(r"^(.*?)[（(]\s*(\d+)[^）)]*[）)]")
+_META_CHARSET_RE = re.compile(rb'charset=["\']?([\w\-]+)', re.I)
+
 
 # ---------------------------------------------------------
 # Basic Functions
@@ -27,63 +69,149 @@ def make_session() -> requests.Session:
     s.trust_env = trust_env
     if not trust_env:
         s.proxies = {}
+    s.headers.update(DEFAULT_HEADERS)
+
+    # keep-alive 接続をプールして一覧・詳細・POST で使い回す
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504)),
+    )
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
     return s
 
 
+_SESSION = make_session()
+
+
+def decode_html(resp: requests.Response) -> str:
+    """Decode a response body, running charset detection only as a last resort."""
+
+    # ヘッダーで charset が宣言されていればそれを信用する
+    if "charset=" in resp.headers.get("Content-Type", "").lower():
+        return resp.text
+    # 次に先頭 2KB の <meta charset> を見る
+    m = _META_CHARSET_RE.search(resp.content[:2048])
+    if m:
+        try:
+            return resp.content.decode(m.group(1).decode("ascii"), "replace")
+        except LookupError:
+            pass
+    try:
+        return resp.content.decode("utf-8")
+    except UnicodeDecodeError:
+        if resp.apparent_encoding:
+            resp.encoding = resp.apparent_encoding
+        return resp.text
+
+
 def fetch_html(url: str) -> str:
-    session = make_session()
-    resp = session.get(url, headers=DEFAULT_HEADERS, timeout=20)
+    resp = _SESSION.get(url, timeout=20)
     resp.raise_for_status()
+    return decode_html(resp)
 
-    if resp.apparent_encoding:
-        resp.encoding = resp.apparent_encoding
 
-    return resp.text
+_DETAIL_CACHE = DetailCache(DETAIL_CACHE_PATH, DETAIL_PARSER_VERSION)
 
 
 def text_content(tag) -> str:
-    return tag.get_text(" ", strip=True) if tag else ""
-
-
-def first_non_empty(*vals):
-    for v in vals:
-        if v:
-            return v
-    return ""
+    if tag is None:
+        return ""
+    # 文字列 1 つだけを持つ葉要素（dd/td など）は get_text の走査を省く
+    contents = tag.contents
+    if len(contents) == 1 and type(contents[0]) is NavigableString:
+        return contents[0].strip()
+    return tag.get_text(" ", strip=True)
 
 
 def extract_age_digits(value: str) -> str:
     if not value:
         return ""
-    m = re.search(r"(\d+)", value)
+    m = _DIGITS_RE.search(value)
     return m.group(1) if m else ""
 
 
+@lru_cache(maxsize=8)
+def split_base_url(base_url: str):
+    return urlsplit(base_url)
+
+
+def join_url(base_url: str, href: str) -> str:
+    # 絶対 URL・スキーム相対・ルート相対はベース URL の再解析なしで組み立てる
+    if href.startswith(("http://", "https://")):
+        return href
+    base = split_base_url(base_url)
+    if href.startswith("//"):
+        return f"{base.scheme}:{href}"
+    if href.startswith("/"):
+        return f"{base.scheme}://{base.netloc}{href}"
+    return urljoin(base_url, href)
+
+
 def sanitize_profile_name(name: str) -> str:
     if not name:
         return ""
-    cleaned = re.sub(r"[^\w\sぁ-ゟ゠-ヿ一-龥々ー０-９Ａ-Ｚａ-ｚー-]+", "", name)
+    # 大半の名前は除去対象の文字を含まないので、置換で文字列を作り直す前に判定する
+    if name.isalnum():
+        return name
+    if not _NAME_CLEAN_RE.search(name):
+        return name.strip()
+    cleaned = _NAME_CLEAN_RE.sub("", name)
     return cleaned.strip()
 
 
 # ---------------------------------------------------------
 # Detail Page Parsing
 # ---------------------------------------------------------
+LABEL_MAP = {
+    "age": ["年齢", "歳", "才"],
+    "height": ["身長", "cm"],
+    "cup": ["カップ", "バスト"],
+    "face_public": ["顔出し", "公開"],
+    "toy": ["おもちゃ", "玩具"],
+    "time_slot": ["出没時間", "時間"],
+    "style": ["スタイル"],
+    "job": ["職業"],
+    "hobby": ["趣味"],
+    "favorite_type": ["好みのタイプ", "好きなタイプ"],
+    "erogenous_zone": ["性感帯"],
+}
+
+_PROFILE_SEL = ".profile, .cast-profile, .profile-box"
+_TAG_SEL = ".tag, .genre, .badge"
+_LABEL_CANDIDATE_SEL = "dt, th, label, strong, b"
+
+# 項目名 → フィールド名を 1 回の正規表現検索で判定する
+_LABEL_RE = re.compile(
+    "|".join(
+        f"(?P<{field}>{'|'.join(map(re.escape, keywords))})"
+        for field, keywords in LABEL_MAP.items()
+    )
+)
+
+
 def extract_background_image(style: str, base_url: str) -> str:
-    match = re.search(r"url\((.*?)\)", style or "")
+    match = _BG_URL_RE.search(style or "")
     if not match:
         return ""
-    return urljoin(base_url, match.group(1).strip("'\""))
+    return join_url(base_url, match.group(1).strip("'\""))
+
+
+@lru_cache(maxsize=None)
+def keyword_pattern(keywords: tuple) -> re.Pattern:
+    return re.compile("|".join(map(re.escape, keywords)))
 
 
 def find_labeled_value(soup: BeautifulSoup, keywords: list[str]) -> str:
-    def matches(tag):
-        if not getattr(tag, "get_text", None):
-            return False
-        t = tag.get_text(strip=True)
-        return any(k in t for k in keywords)
+    # 全ノードを走査せず、ラベルになり得る要素だけを順に調べる
+    pattern = keyword_pattern(tuple(keywords))
+    label = None
+    for node in soup.select(_LABEL_CANDIDATE_SEL):
+        if pattern.search(node.get_text(strip=True)):
+            label = node
+            break
 
-    label = soup.find(matches)
     if not label:
         return ""
 
@@ -108,8 +236,14 @@ def parse_detail_page(detail_url: str) -> dict:
             "genre_detail"
         ]}
 
-    html = fetch_html(detail_url)
-    soup = BeautifulSoup(html, "html.parser")
+    headers = _DETAIL_CACHE.request_headers(detail_url)
+    resp = _SESSION.get(detail_url, headers=headers, timeout=20)
+    if resp.status_code == 304:
+        cached = _DETAIL_CACHE.cached_fields(detail_url)
+        if cached is not None:
+            return cached
+    resp.raise_for_status()
+    soup = BeautifulSoup(decode_html(resp), HTML_PARSER)
 
     fields = {
         "age": "",
@@ -126,21 +260,7 @@ def parse_detail_page(detail_url: str) -> dict:
         "genre_detail": "",
     }
 
-    label_map = {
-        "age": ["年齢", "歳", "才"],
-        "height": ["身長", "cm"],
-        "cup": ["カップ", "バスト"],
-        "face_public": ["顔出し", "公開"],
-        "toy": ["おもちゃ", "玩具"],
-        "time_slot": ["出没時間", "時間"],
-        "style": ["スタイル"],
-        "job": ["職業"],
-        "hobby": ["趣味"],
-        "favorite_type": ["好みのタイプ", "好きなタイプ"],
-        "erogenous_zone": ["性感帯"],
-    }
-
-    container = soup.select_one(".profile, .cast-profile, .profile-box")
+    container = soup.select_one(_PROFILE_SEL)
 
     if container:
         for dl in container.select("dl"):
@@ -150,9 +270,9 @@ def parse_detail_page(detail_url: str) -> dict:
             val = text_content(dd)
             if not label:
                 continue
-            for key, keys in label_map.items():
-                if any(k in label for k in keys):
-                    fields[key] = val
+            m = _LABEL_RE.search(label)
+            if m:
+                fields[m.lastgroup] = val
 
         for table in container.select("table"):
             for tr in table.select("tr"):
@@ -162,41 +282,70 @@ def parse_detail_page(detail_url: str) -> dict:
                 val = text_content(td)
                 if not label:
                     continue
-                for key, keys in label_map.items():
-                    if any(k in label for k in keys):
-                        fields[key] = val
+                m = _LABEL_RE.search(label)
+                if m:
+                    fields[m.lastgroup] = val
 
-        tags = [text_content(t) for t in container.select(".tag, .genre, .badge")]
+        tags = [text_content(t) for t in container.select(_TAG_SEL)]
         tags = [x for x in tags if x]
         if tags:
             fields["genre_detail"] = ", ".join(tags)
 
-    fields["age"] = extract_age_digits(first_non_empty(
-        fields["age"],
-        find_labeled_value(soup, label_map["age"]),
-    ))
+    fields["age"] = extract_age_digits(
+        fields["age"] or find_labeled_value(soup, LABEL_MAP["age"])
+    )
+
+    _DETAIL_CACHE.store(detail_url, resp, fields)
 
     return fields
 
 
+def safe_parse_detail_page(detail_url: str) -> dict:
+    try:
+        return parse_detail_page(detail_url)
+    except Exception as exc:
+        print(f"Detail fetch failed for {detail_url}: {exc}")
+        return {}
+
+
 # ---------------------------------------------------------
 # Card Extraction
 # ---------------------------------------------------------
-def extract_card_info(card, base_url: str) -> dict:
-    name_el = card.select_one("h3.girl-prof__name, .girl-prof__name, h3, h4")
-    comment_el = card.select_one("div.girl-comment p.girl-comment__txt, .girl-comment__txt")
+_CARD_PARTS_SEL = "h3, h4, .girl-prof__name, .girl-comment__txt, .girl-pic__image[style], a[href]"
+
+
+def find_card_parts(card) -> tuple:
+    """Collect name, comment, picture and link elements in one subtree walk."""
+
+    name_el = comment_el = pic = link = fallback_link = None
+    for node in card.select(_CARD_PARTS_SEL):
+        classes = node.get("class") or []
+        if name_el is None and (node.name in {"h3", "h4"} or "girl-prof__name" in classes):
+            name_el = node
+        if comment_el is None and "girl-comment__txt" in classes:
+            comment_el = node
+        if pic is None and "girl-pic__image" in classes and node.has_attr("style"):
+            pic = node
+        if node.name == "a" and node.has_attr("href"):
+            if link is None and "girl-link" in classes:
+                link = node
+            if fallback_link is None:
+                fallback_link = node
+
+    return name_el, comment_el, pic, link or fallback_link
+
+
+def extract_card_info(parts: tuple, detail_url: str, base_url: str) -> dict:
+    # parts は find_card_parts の結果、detail_url は重複除去で解決済みのリンク URL
+    name_el, comment_el, pic, _link = parts
     raw_name = text_content(name_el)
 
     thumb = ""
-    pic = card.select_one(".girl-pic__image[style]")
-    if pic and pic.has_attr("style"):
+    if pic:
         thumb = extract_background_image(pic["style"], base_url)
 
-    link = card.select_one("a.girl-link[href]") or card.find("a", href=True)
-    detail_url = urljoin(base_url, link["href"]) if link else ""
-
     age_from_name = ""
-    m = re.match(r"^(.*?)[（(]\s*(\d+)[^）)]*[）)]", raw_name)
+    m = _NAME_AGE_RE.match(raw_name)
     if m:
         name = m.group(1).strip()
         age_from_name = m.group(2)
@@ -224,6 +373,25 @@ def fill_with_dash(item: dict) -> dict:
     return item
 
 
+# ---------------------------------------------------------
+# API Posting
+# ---------------------------------------------------------
+def post_to_wp(item: dict) -> bool:
+    try:
+        r = _SESSION.post(API_URL, data=dump_json(item), headers=API_HEADERS, timeout=20)
+    except RequestException as exc:
+        print(f"Post failed for {item['name']} (status=no-status): {exc}")
+        return False
+
+    # 本文のデコードは失敗時だけ行い、成功時はステータスのみ記録する
+    if r.ok:
+        print("Posted:", item["name"], r.status_code)
+        return True
+
+    print(f"Post failed for {item['name']} (status={r.status_code}): {r.text}")
+    return False
+
+
 # ---------------------------------------------------------
 # Main Scraper
 # ---------------------------------------------------------
@@ -233,36 +401,43 @@ def scrape_angel():
     base_url = env_base if env_base.startswith("http") else "https://www.angel-live.com/home/"
 
     html = fetch_html(base_url)
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(html, HTML_PARSER)
 
     cards = soup.select("li.girl-line__item, li.girl-line__item.chatbox_big, li.girl-line__item.chatbox_big.event_now")
     if not cards:
         cards = soup.select("li.girl-line__item") or soup.select("li")
 
-    seen = set()
-    items = []
-
+    # カードの要素はリンクも含めて 1 回の走査で集め、リンク URL で重複を除いてから解析する
+    unique_cards = {}
     for card in cards:
-        info = extract_card_info(card, base_url)
-
-        if not info["url"].startswith("http"):
+        parts = find_card_parts(card)
+        link = parts[3]
+        if not link:
             continue
-        if info["url"] in seen:
-            continue
-        seen.add(info["url"])
+        url = join_url(base_url, link["href"])
+        if url.startswith("http"):
+            unique_cards.setdefault(url, parts)
 
-        try:
-            detail = parse_detail_page(info["url"])
-        except Exception as exc:
-            print(f"Detail fetch failed for {info['url']}: {exc}")
-            detail = {}
+    infos = [extract_card_info(parts, url, base_url) for url, parts in unique_cards.items()]
 
+    # 詳細ページは I/O 待ちが支配的なので並列で取得する
+    _DETAIL_CACHE.load()
+    with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as executor:
+        details = list(executor.map(safe_parse_detail_page, [info["url"] for info in infos]))
+    try:
+        _DETAIL_CACHE.save()
+    except OSError as exc:
+        print(f"Detail cache save failed: {exc}")
+
+    items = []
+
+    for info, detail in zip(infos, details):
         item = {
             "name": info["name"],
             "samune": info["samune"],
             "url": info["url"],
             "oneword": info["oneword"],
-            "age": extract_age_digits(first_non_empty(detail.get("age", ""), info.get("age_from_name"))) or "-",
+            "age": extract_age_digits(detail.get("age") or info.get("age_from_name") or "") or "-",
             "height": detail.get("height", "") or "-",
             "cup": detail.get("cup", "") or "-",
             "face_public": detail.get("face_public", "") or "-",
@@ -279,23 +454,16 @@ def scrape_angel():
         fill_with_dash(item)
         items.append(item)
 
-    headers = {"X-API-KEY": API_KEY}
-    success = 0
-
+    postable = []
     for item in items:
         if not item["url"].startswith("http"):
             print("Skipping invalid URL:", item["url"])
             continue
+        postable.append(item)
 
-        try:
-            r = requests.post(API_URL, json=item, headers=headers, timeout=20)
-            r.raise_for_status()
-            success += 1
-            print("Posted:", item["name"], r.text)
-        except RequestException as exc:
-            status = getattr(exc.response, "status_code", "no-status")
-            body = getattr(exc.response, "text", "")
-            print(f"Post failed for {item['name']} (status={status}): {body}")
+    # POST も I/O 待ちなので並列で送信（接続はセッションのプールを共有）
+    with ThreadPoolExecutor(max_workers=POST_WORKERS) as executor:
+        success = sum(executor.map(post_to_wp, postable))
 
     print("完了：Angel Live 送信数 →", success)
 
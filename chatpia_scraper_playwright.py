@@ -1,17 +1,50 @@
+import json
 import os
 import re
-from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urljoin, urlsplit
 
 import requests
 from requests import RequestException
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 from playwright.sync_api import sync_playwright
 
+# lxml（C 実装）があれば使い、無ければ標準の html.parser にフォールバック
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# orjson があれば POST 本文のシリアライズに使う
+try:
+    import orjson
+
+    def dump_json(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def dump_json(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
 API_URL = os.environ.get("API_URL")
 API_KEY = os.environ.get("API_KEY")
+# API キーはスクレイピング先に送らないよう、セッション共通ヘッダーではなく POST 時のみ付与する
+API_HEADERS = {"X-API-KEY": API_KEY, "Content-Type": "application/json"}
+
+# 詳細ページ取得・API 送信の同時実行数
+DETAIL_WORKERS = 10
+POST_WORKERS = 8
 
 BASE_URL = os.environ.get("CHATPIA_BASE_URL", "https://www.chatpia.jp/main.php").strip() or "https://www.chatpia.jp/main.php"
 
+# 1 にすると一覧ページを常に Playwright で描画する（既定は requests で取得し、有効なカードが無ければ描画）
+USE_BROWSER = os.environ.get("CHATPIA_USE_BROWSER", "0") not in {"0", "false", "False", ""}
+
 # ブラウザ用ヘッダー
 DEFAULT_HEADERS = {
     "User-Agent": (
@@ -22,67 +55,161 @@ DEFAULT_HEADERS = {
     "Referer": "https://www.chatpia.jp/",
 }
 
+_BG_URL_RE = re.compile(r"url\((.*?)\)")
+_DIGITS_RE = re.compile(r"(\d+)")
+_NAME_CLEAN_RE = re.compile(r"[^\w\sぁ-ゟ゠-ヿ一-龥々ー０-９Ａ-Ｚａ-ｚー-]+")
+_PAREN_RE = re.compile(r"\(.*?\)")
+_CUP_RE = re.compile(r"([A-ZＡ-Ｚ])カップ")
+_META_CHARSET_RE = re.compile(rb'charset=["\']?([\w\-]+)', re.I)
+
+
+def make_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+
+    # keep-alive 接続をプールして詳細ページ・POST で使い回す
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504)),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_SESSION = make_session()
 
-def text_content(tag) -> str:
-    return tag.get_text(" ", strip=True) if tag else ""
 
+def decode_html(resp: requests.Response) -> str:
+    """Decode a response body, running charset detection only as a last resort."""
+
+    # ヘッダーで charset が宣言されていればそれを信用する
+    if "charset=" in resp.headers.get("Content-Type", "").lower():
+        return resp.text
+    # 次に先頭 2KB の <meta charset> を見る
+    m = _META_CHARSET_RE.search(resp.content[:2048])
+    if m:
+        try:
+            return resp.content.decode(m.group(1).decode("ascii"), "replace")
+        except LookupError:
+            pass
+    try:
+        return resp.content.decode("utf-8")
+    except UnicodeDecodeError:
+        if resp.apparent_encoding:
+            resp.encoding = resp.apparent_encoding
+        return resp.text
 
-def first_non_empty(*vals):
-    for v in vals:
-        if v:
-            return v
-    return ""
+
+def text_content(tag) -> str:
+    if tag is None:
+        return ""
+    # 文字列 1 つだけを持つ葉要素（dd/td など）は get_text の走査を省く
+    contents = tag.contents
+    if len(contents) == 1 and type(contents[0]) is NavigableString:
+        return contents[0].strip()
+    return tag.get_text(" ", strip=True)
 
 
 def extract_age_digits(value: str) -> str:
     if not value:
         return ""
-    m = re.search(r"(\d+)", value)
+    m = _DIGITS_RE.search(value)
     return m.group(1) if m else ""
 
 
+@lru_cache(maxsize=8)
+def split_base_url(base_url: str):
+    return urlsplit(base_url)
+
+
+def join_url(base_url: str, href: str) -> str:
+    # 絶対 URL・スキーム相対・ルート相対はベース URL の再解析なしで組み立てる
+    if href.startswith(("http://", "https://")):
+        return href
+    base = split_base_url(base_url)
+    if href.startswith("//"):
+        return f"{base.scheme}:{href}"
+    if href.startswith("/"):
+        return f"{base.scheme}://{base.netloc}{href}"
+    return urljoin(base_url, href)
+
+
 def sanitize_profile_name(name: str) -> str:
     if not name:
         return ""
-    cleaned = re.sub(r"[^\w\sぁ-ゟ゠-ヿ一-龥々ー０-９Ａ-Ｚａ-ｚー-]+", "", name)
+    # 大半の名前は除去対象の文字を含まないので、置換で文字列を作り直す前に判定する
+    if name.isalnum():
+        return name
+    if not _NAME_CLEAN_RE.search(name):
+        return name.strip()
+    cleaned = _NAME_CLEAN_RE.sub("", name)
     return cleaned.strip()
 
 
 # ---------------------- 一覧カード ----------------------
-def extract_card_info(card, base_url: str) -> dict:
+_CARD_PARTS_SEL = ".name, .pict, .hitokoto, .hitokoto_taiki, .hitokoto_new"
+_COMMENT_CLASSES = frozenset({"hitokoto", "hitokoto_taiki", "hitokoto_new"})
+_CARD_SEL = "div.chatbox_big, div.chatbox_small"
+# ブラウザで一覧を描画する際に読み込まないリソース（DOM だけあれば十分）
+_BLOCKED_RESOURCE_TYPES = frozenset({"image", "media", "font", "stylesheet"})
+# 解析中の class は "chatbox_big online" のような生の文字列で比較されるため、単語単位の正規表現で判定する。
+# フォールバックの .line はタグを問わないので、タグ名では絞り込まない
+_CARD_STRAINER = SoupStrainer(
+    class_=re.compile(r"(?:^|\s)(?:chatbox_big|chatbox_small|chatbox-box|line)(?:\s|$)")
+)
+
+
+def find_card_parts(card) -> tuple:
+    """Collect the name block, picture and comment elements in one subtree walk."""
+
+    name_block = pict_el = comment_el = None
+    for node in card.select(_CARD_PARTS_SEL):
+        classes = node.get("class") or []
+        if name_block is None and "name" in classes:
+            name_block = node
+        if pict_el is None and "pict" in classes:
+            pict_el = node
+        if comment_el is None and not _COMMENT_CLASSES.isdisjoint(classes):
+            comment_el = node
+    return name_block, pict_el, comment_el
+
+
+def extract_card_info(card, base_url: str) -> dict | None:
+    name_block, pict_el, comment_el = find_card_parts(card)
+
+    # 必須要素（リンク・サムネ・一言）が欠けたカードは名前の整形などを行う前に捨てる
+    name_el = name_block.find("a", href=True) if name_block else None
+    if name_el is None or comment_el is None or pict_el is None or not pict_el.has_attr("style"):
+        return None
+
     # 名前
-    name_el = card.select_one(".name a")
     raw_name = text_content(name_el)
-    raw_name_no_age = re.sub(r"\(.*?\)", "", raw_name).strip()
+    # 括弧が無ければ置換は不要（大半の名前はこちら）
+    raw_name_no_age = _PAREN_RE.sub("", raw_name).strip() if "(" in raw_name else raw_name
     name = sanitize_profile_name(raw_name_no_age)
 
     # URL
-    detail_url = ""
-    if name_el and name_el.has_attr("href"):
-        detail_url = urljoin(base_url, name_el["href"])
+    detail_url = join_url(base_url, name_el["href"])
 
     # サムネ
     thumb = ""
-    pict_el = card.select_one(".pict")
-    if pict_el and pict_el.has_attr("style"):
-        m = re.search(r"url\((.*?)\)", pict_el["style"])
-        if m:
-            raw = m.group(1).strip("'\"")
-            if raw.startswith("//"):
-                raw = f"https:{raw}"
-            thumb = raw
+    m = _BG_URL_RE.search(pict_el["style"])
+    if m:
+        raw = m.group(1).strip("'\"")
+        if raw.startswith("//"):
+            raw = f"https:{raw}"
+        thumb = raw
 
     # ひとこと
-    comment_el = card.select_one(".hitokoto, .hitokoto_taiki, .hitokoto_new")
     oneword = text_content(comment_el)
 
     # 年齢
     age_from_name = ""
-    name_block = card.select_one(".name")
-    if name_block:
-        m = re.search(r"(\d+)", text_content(name_block))
-        if m:
-            age_from_name = m.group(1)
+    m = _DIGITS_RE.search(text_content(name_block))
+    if m:
+        age_from_name = m.group(1)
 
     return {
         "name": name or "-",
@@ -94,6 +221,27 @@ def extract_card_info(card, base_url: str) -> dict:
 
 
 # ---------------------- 詳細プロフィール ----------------------
+# 項目名のキーワード → フィールド名（並び順が優先順位）
+_KW_TO_KEY = {
+    "身長": "height",
+    "スリーサイズ": "cup",
+    "職業": "job",
+    "趣味": "hobby",
+    "男性のタイプ": "favorite_type",
+    "出没時間": "time_slot",
+}
+
+
+@lru_cache(maxsize=256)
+def label_field(label: str) -> str | None:
+    # _KW_TO_KEY の定義順で最初に含まれるキーワードの項目を採る（身長 > スリーサイズ > 職業 > …）。
+    # 同じ項目名はページ間で繰り返し出るので結果を使い回す
+    for keyword, key in _KW_TO_KEY.items():
+        if keyword in label:
+            return key
+    return None
+
+
 def parse_detail_page(detail_url: str) -> dict:
     if not detail_url:
         return {
@@ -112,14 +260,10 @@ def parse_detail_page(detail_url: str) -> dict:
         }
 
     # requests で詳細ページを取得（ここもPlaywrightにしたいなら差し替え可）
-    session = requests.Session()
-    session.headers.update(DEFAULT_HEADERS)
-    resp = session.get(detail_url, timeout=20)
+    resp = _SESSION.get(detail_url, timeout=20)
     resp.raise_for_status()
-    if resp.apparent_encoding:
-        resp.encoding = resp.apparent_encoding
 
-    soup = BeautifulSoup(resp.text, "html.parser")
+    soup = BeautifulSoup(decode_html(resp), HTML_PARSER)
 
     fields = {
         "age": "",
@@ -147,23 +291,26 @@ def parse_detail_page(detail_url: str) -> dict:
         label = text_content(dt)
         val = text_content(dd)
 
-        if "身長" in label:
-            fields["height"] = val
-        elif "スリーサイズ" in label:
-            m = re.search(r"([A-ZＡ-Ｚ])カップ", val)
-            fields["cup"] = m.group(0) if m else val
-        elif "職業" in label:
-            fields["job"] = val
-        elif "趣味" in label:
-            fields["hobby"] = val
-        elif "男性のタイプ" in label:
-            fields["favorite_type"] = val
-        elif "出没時間" in label:
-            fields["time_slot"] = val
+        key = label_field(label)
+        if not key:
+            continue
+
+        if key == "cup":
+            cup = _CUP_RE.search(val)
+            val = cup.group(0) if cup else val
+        fields[key] = val
 
     return fields
 
 
+def safe_parse_detail_page(detail_url: str) -> dict:
+    try:
+        return parse_detail_page(detail_url)
+    except Exception as exc:
+        print(f"Detail fetch error for {detail_url}: {exc}")
+        return {}
+
+
 def fill_with_dash(item: dict) -> dict:
     for k, v in item.items():
         if v is None or (isinstance(v, str) and not v.strip()):
@@ -171,11 +318,25 @@ def fill_with_dash(item: dict) -> dict:
     return item
 
 
-# ---------------------- メイン処理 ----------------------
-def scrape_chatpia():
-    success = 0
-    items = []
+# ---------------------- API送信 ----------------------
+def post_to_wp(item: dict) -> bool:
+    try:
+        r = _SESSION.post(API_URL, data=dump_json(item), headers=API_HEADERS, timeout=20)
+    except RequestException as exc:
+        print(f"Post failed for {item['name']} (status=no-status): {exc}")
+        return False
+
+    # 本文のデコードは失敗時だけ行い、成功時はステータスのみ記録する
+    if r.ok:
+        print("Posted:", item["name"], r.status_code)
+        return True
+
+    print(f"Post failed for {item['name']} (status={r.status_code}): {r.text}")
+    return False
 
+
+# ---------------------- メイン処理 ----------------------
+def fetch_listing_html_with_browser() -> str:
     with sync_playwright() as p:
         browser = p.chromium.launch(headless=True)
         context = browser.new_context(
@@ -186,75 +347,107 @@ def scrape_chatpia():
                 "Referer": DEFAULT_HEADERS["Referer"],
             },
         )
+        # サムネイルは style 属性の URL を読むだけなので、画像・CSS・フォントは取得しない
+        context.route(
+            "**/*",
+            lambda route: route.abort()
+            if route.request.resource_type in _BLOCKED_RESOURCE_TYPES
+            else route.continue_(),
+        )
         page = context.new_page()
-        page.goto(BASE_URL, wait_until="networkidle", timeout=30000)
+        # networkidle は解析用の通信まで待ってしまうため、カードの出現だけを待つ
+        page.goto(BASE_URL, wait_until="domcontentloaded", timeout=30000)
+        try:
+            page.wait_for_selector(_CARD_SEL, timeout=15000)
+        except PlaywrightTimeoutError:
+            # 旧レイアウト（chatbox-box / line）の可能性もあるので、通信が落ち着くまで少しだけ待つ
+            print("Timed out waiting for Chatpia cards; waiting briefly for network idle")
+            try:
+                page.wait_for_load_state("networkidle", timeout=5000)
+            except PlaywrightTimeoutError:
+                print("Network did not go idle; using the page as rendered so far")
 
         html = page.content()
-        soup = BeautifulSoup(html, "html.parser")
+        browser.close()
+    return html
 
-        cards = soup.select("div.chatbox_big, div.chatbox_small")
-        if not cards:
-            cards = soup.select("div.chatbox-box, .line")
 
-        seen_urls = set()
+def find_cards(html: str) -> list:
+    # カードになり得る要素だけを木にする（広告・フッター等のノード生成を省く）
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=_CARD_STRAINER)
 
-        for card in cards:
-            info = extract_card_info(card, BASE_URL)
+    cards = soup.select(_CARD_SEL)
+    if not cards:
+        cards = soup.select("div.chatbox-box, .line")
+    return cards
 
-            # 必須：サムネ & 一言 & URL
-            if not info["samune"] or not info["oneword"]:
-                continue
-            if not info["url"].startswith("http"):
-                continue
-            if info["url"] in seen_urls:
-                continue
-            seen_urls.add(info["url"])
 
-            # 詳細ページ解析
-            try:
-                detail = parse_detail_page(info["url"])
-            except Exception as exc:
-                print(f"Detail fetch error for {info['url']}: {exc}")
-                detail = {}
-
-            item = {
-                "name": info["name"],
-                "samune": info["samune"],
-                "url": info["url"],
-                "oneword": info["oneword"],
-                "age": extract_age_digits(
-                    first_non_empty(detail.get("age", ""), info.get("age_from_name"))
-                ) or "-",
-                "height": detail.get("height", "") or "-",
-                "cup": detail.get("cup", "") or "-",
-                "face_public": detail.get("face_public", "") or "-",
-                "toy": detail.get("toy", "") or "-",
-                "time_slot": detail.get("time_slot", "") or "-",
-                "style": detail.get("style", "") or "-",
-                "job": detail.get("job", "") or "-",
-                "hobby": detail.get("hobby", "") or "-",
-                "favorite_type": detail.get("favorite_type", "") or "-",
-                "erogenous_zone": detail.get("erogenous_zone", "") or "-",
-                "genre": detail.get("genre_detail", "") or "Chatpia",
-            }
-
-            fill_with_dash(item)
-            items.append(item)
+def collect_infos(cards: list) -> list:
+    infos = []
+    seen_urls = set()
+
+    for card in cards:
+        info = extract_card_info(card, BASE_URL)
+
+        # 必須：サムネ & 一言 & URL
+        if info is None or not info["samune"] or not info["oneword"]:
+            continue
+        if not info["url"].startswith("http"):
+            continue
+        if info["url"] in seen_urls:
+            continue
+        seen_urls.add(info["url"])
+        infos.append(info)
+    return infos
 
-        browser.close()
 
-    # API送信
-    headers = {"X-API-KEY": API_KEY}
-    for item in items:
+def scrape_chatpia():
+    # 一覧がサーバー側で描画されていれば requests だけで済ませ、
+    # 有効なカードが 1 件も取れない場合（JS で中身を埋める枠だけの HTML など）にだけブラウザを起動する
+    infos = []
+    if not USE_BROWSER:
         try:
-            r = requests.post(API_URL, json=item, headers=headers, timeout=20)
-            r.raise_for_status()
-            success += 1
-            print("Posted:", item["name"], r.text)
+            resp = _SESSION.get(BASE_URL, timeout=20)
+            resp.raise_for_status()
+            infos = collect_infos(find_cards(decode_html(resp)))
         except RequestException as exc:
-            status = getattr(exc.response, "status_code", "no-status")
-            body = getattr(exc.response, "text", "")
-            print(f"Post failed for {item['name']} (status={status}): {body}")
+            print(f"Listing fetch failed without browser: {exc}")
+    if not infos:
+        infos = collect_infos(find_cards(fetch_listing_html_with_browser()))
+
+    # 詳細ページ解析（I/O 待ちが支配的なので並列で取得）
+    with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as executor:
+        details = list(executor.map(safe_parse_detail_page, [info["url"] for info in infos]))
+
+    items = []
+    for info, detail in zip(infos, details):
+        item = {
+            "name": info["name"],
+            "samune": info["samune"],
+            "url": info["url"],
+            "oneword": info["oneword"],
+            "age": extract_age_digits(
+                detail.get("age") or info.get("age_from_name") or ""
+            ) or "-",
+            "height": detail.get("height", "") or "-",
+            "cup": detail.get("cup", "") or "-",
+            "face_public": detail.get("face_public", "") or "-",
+            "toy": detail.get("toy", "") or "-",
+            "time_slot": detail.get("time_slot", "") or "-",
+            "style": detail.get("style", "") or "-",
+            "job": detail.get("job", "") or "-",
+            "hobby": detail.get("hobby", "") or "-",
+            "favorite_type": detail.get("favorite_type", "") or "-",
+            "erogenous_zone": detail.get("erogenous_zone", "") or "-",
+            "genre": detail.get("genre_detail", "") or "Chatpia",
+        }
+
+        fill_with_dash(item)
+        items.append(item)
+
+    # API送信（I/O 待ちなので並列で送信、接続はセッションのプールを共有）
+    with ThreadPoolExecutor(max_workers=POST_WORKERS) as executor:
+        success = sum(executor.map(post_to_wp, items))
 
     print("完了：Chatpia 送信数 →", success)
 
@@ -0,0 +1,60 @@
+import json
+import os
+
+
+class DetailCache:
+    """Per-URL ETag / Last-Modified validators and parsed fields for detail pages."""
+
+    def __init__(self, path: str, parser_version: int) -> None:
+        self.path = path
+        self.parser_version = parser_version
+        self._entries: dict = {}
+        self._seen: set = set()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        # 保存しているのは解析結果なので、解析処理の版が違えば 304 でも古い結果を返さないよう丸ごと捨てる
+        if isinstance(data, dict) and data.get("parser_version") == self.parser_version:
+            self._entries.update(data.get("entries") or {})
+
+    def request_headers(self, url: str) -> dict:
+        # 今回の実行で扱った URL を記録しておき、保存時にそれ以外を捨てる
+        self._seen.add(url)
+        cached = self._entries.get(url)
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        return headers
+
+    def cached_fields(self, url: str) -> dict | None:
+        cached = self._entries.get(url)
+        return dict(cached["fields"]) if cached else None
+
+    def store(self, url: str, resp, fields: dict) -> None:
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        if etag or last_modified:
+            self._entries[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "fields": fields,
+            }
+        else:
+            # 検証子が無くなったページに古い検証子を送り続けない
+            self._entries.pop(url, None)
+
+    def save(self) -> None:
+        # 一覧から消えた URL は残さず、ファイルが際限なく大きくならないようにする
+        entries = {url: e for url, e in self._entries.items() if url in self._seen}
+        # 書き込み途中で落ちても壊れたキャッシュが残らないよう一時ファイルから置き換える
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"parser_version": self.parser_version, "entries": entries}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
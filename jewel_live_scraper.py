@@ -1,12 +1,50 @@
+import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from urllib.parse import urljoin
 
 import requests
-from bs4 import BeautifulSoup
+import soupsieve as sv
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer
+
+from detail_cache import DetailCache
+
+# lxml（C 実装）があれば使い、無ければ標準の html.parser にフォールバック
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# orjson があれば POST 本文のシリアライズに使う
+try:
+    import orjson
+
+    def dump_json(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def dump_json(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
 API_URL = os.environ.get("API_URL")   # https://s360.jp/index.php?rest_route=/jewel/v1/insert
 API_KEY = os.environ.get("API_KEY")   # dLMVcn6fFSP8jzG1SxzAwnmOnCAmC9KqJK6Ykkp2
+# API キーはスクレイピング先に送らないよう、セッション共通ヘッダーではなく POST 時のみ付与する
+API_HEADERS = {"X-API-KEY": API_KEY, "Content-Type": "application/json"}
+
+# 詳細ページ取得・API 送信の同時実行数
+DETAIL_WORKERS = 8
+POST_WORKERS = 8
+
+# 詳細ページの ETag / Last-Modified と解析結果を保存し、次回は条件付き GET で 304 なら再解析しない
+DETAIL_CACHE_PATH = os.environ.get("J_LIVE_DETAIL_CACHE", "jewel_detail_cache.json")
+# parse_detail_page の出力が変わる修正をしたら上げる（古い解析結果のキャッシュを捨てる）
+DETAIL_PARSER_VERSION = 1
 
 DEFAULT_HEADERS = {
     "User-Agent": (
@@ -15,6 +53,8 @@ DEFAULT_HEADERS = {
     )
 }
 
+_META_CHARSET_RE = re.compile(rb'charset=["\']?([\w\-]+)', re.I)
+
 
 def make_session() -> requests.Session:
     """Create a session that optionally ignores proxy env vars.
@@ -29,35 +69,79 @@ def make_session() -> requests.Session:
     session.trust_env = trust_env
     if not trust_env:
         session.proxies = {}
+    session.headers.update(DEFAULT_HEADERS)
+
+    # keep-alive 接続をプールして一覧・詳細・POST で使い回す
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     return session
 
 
+_SESSION = make_session()
+
+
+def decode_html(resp: requests.Response) -> str:
+    """Decode a response body, running charset detection only as a last resort."""
+
+    # ヘッダーで charset が宣言されていればそれを信用する
+    if "charset=" in resp.headers.get("Content-Type", "").lower():
+        return resp.text
+    # 次に先頭 2KB の <meta charset> を見る
+    m = _META_CHARSET_RE.search(resp.content[:2048])
+    if m:
+        try:
+            return resp.content.decode(m.group(1).decode("ascii"), "replace")
+        except LookupError:
+            pass
+    try:
+        return resp.content.decode("utf-8")
+    except UnicodeDecodeError:
+        if resp.apparent_encoding:
+            resp.encoding = resp.apparent_encoding
+        return resp.text
+
+
 def fetch_html(url: str) -> str:
-    session = make_session()
-    resp = session.get(url, headers=DEFAULT_HEADERS, timeout=20)
+    resp = _SESSION.get(url, timeout=20)
     resp.raise_for_status()
-    return resp.text
+    return decode_html(resp)
+
+
+_DETAIL_CACHE = DetailCache(DETAIL_CACHE_PATH, DETAIL_PARSER_VERSION)
 
 
 def text_content(tag) -> str:
-    return tag.get_text(" ", strip=True) if tag else ""
+    if tag is None:
+        return ""
+    # 文字列 1 つだけを持つ葉要素（dd/td など）は get_text の走査を省く
+    contents = tag.contents
+    if len(contents) == 1 and type(contents[0]) is NavigableString:
+        return contents[0].strip()
+    return tag.get_text(" ", strip=True)
+
+
+_LABEL_CANDIDATE_SEL = "dt, th, label, strong, b"
+
+
+@lru_cache(maxsize=None)
+def keyword_pattern(keywords: tuple) -> re.Pattern:
+    return re.compile("|".join(map(re.escape, keywords)))
 
 
-def first_non_empty(*values: str) -> str:
-    for value in values:
-        if value:
-            return value
-    return ""
+def label_candidates(soup: BeautifulSoup) -> list[tuple[str, object]]:
+    # 全ノードに Python の判定関数を当てず、ラベルになり得る要素だけをテキストと組で 1 度集める
+    return [(node.get_text(strip=True), node) for node in soup.select(_LABEL_CANDIDATE_SEL)]
 
 
-def find_labeled_value(soup: BeautifulSoup, keywords: list[str]) -> str:
-    def matches(tag):
-        if not getattr(tag, "get_text", None):
-            return False
-        text = tag.get_text(strip=True)
-        return any(key in text for key in keywords)
+def find_labeled_value(candidates: list[tuple[str, object]], keywords: list[str]) -> str:
+    pattern = keyword_pattern(tuple(keywords))
+    label = next((node for text, node in candidates if pattern.search(text)), None)
 
-    label = soup.find(matches)
     if not label:
         return ""
 
@@ -74,11 +158,50 @@ def find_labeled_value(soup: BeautifulSoup, keywords: list[str]) -> str:
     return text_content(sibling)
 
 
+# 項目ごとのフォールバック用セレクタ（1 回の select で済むようカンマで結合）
+_FALLBACK_SEL = {
+    "age": "dd.p-age, span.age, li.age, td.age",
+    "height": "dd.p-height, span.height, li.height, td.height",
+    "cup": "dd.p-cup, span.cup, li.cup, td.cup",
+    "face_public": "dd.p-face, span.face, li.face, td.face",
+}
+
+LABEL_MAP = {
+    "age": ["年齢", "歳", "才"],
+    "height": ["身長", "cm"],
+    "cup": ["カップ", "バスト"],
+    "face_public": ["顔出し", "顔", "公開"],
+    "toy": ["おもちゃ"],
+    "time_slot": ["出没時間", "時間"],
+    "style": ["スタイル"],
+    "job": ["職業"],
+    "hobby": ["趣味"],
+    "favorite_type": ["好みのタイプ", "好きなタイプ"],
+    "erogenous_zone": ["性感帯"],
+}
+
+
+@lru_cache(maxsize=256)
+def label_field(label: str) -> str | None:
+    # 項目名 → フィールド名。LABEL_MAP の定義順で最初に該当した項目を採る
+    # （「バスト(cm)」は先に並ぶ身長の "cm" に該当する）。同じ項目名はページ間で繰り返し出るので結果を使い回す
+    for field, keywords in LABEL_MAP.items():
+        if any(key in label for key in keywords):
+            return field
+    return None
+
+
 def parse_detail_page(detail_url: str) -> dict:
     """Parse detail page-only fields from Jewel Live profiles."""
 
-    html = fetch_html(detail_url)
-    soup = BeautifulSoup(html, "html.parser")
+    headers = _DETAIL_CACHE.request_headers(detail_url)
+    resp = _SESSION.get(detail_url, headers=headers, timeout=20)
+    if resp.status_code == 304:
+        cached = _DETAIL_CACHE.cached_fields(detail_url)
+        if cached is not None:
+            return cached
+    resp.raise_for_status()
+    soup = BeautifulSoup(decode_html(resp), HTML_PARSER)
 
     fields = {
         "age": "",
@@ -95,20 +218,6 @@ def parse_detail_page(detail_url: str) -> dict:
         "genre_detail": "",
     }
 
-    label_map = {
-        "age": ["年齢", "歳", "才"],
-        "height": ["身長", "cm"],
-        "cup": ["カップ", "バスト"],
-        "face_public": ["顔出し", "顔", "公開"],
-        "toy": ["おもちゃ"],
-        "time_slot": ["出没時間", "時間"],
-        "style": ["スタイル"],
-        "job": ["職業"],
-        "hobby": ["趣味"],
-        "favorite_type": ["好みのタイプ", "好きなタイプ"],
-        "erogenous_zone": ["性感帯"],
-    }
-
     profile_box = soup.select_one("div.profile-box")
     if profile_box:
         for dl in profile_box.select("dl.profile-dl"):
@@ -119,10 +228,9 @@ def parse_detail_page(detail_url: str) -> dict:
             if not label:
                 continue
 
-            for field, keywords in label_map.items():
-                if any(key in label for key in keywords):
-                    fields[field] = value
-                    break
+            field = label_field(label)
+            if field:
+                fields[field] = value
 
         genre_dd = profile_box.select_one("dd.genre-list")
         if genre_dd:
@@ -131,83 +239,113 @@ def parse_detail_page(detail_url: str) -> dict:
                 active_genres = [text_content(div) for div in genre_dd.select("div.genre-div")]
             fields["genre_detail"] = ", ".join(filter(None, active_genres))
 
-    selectors = {
-        "age": ["dd.p-age", "span.age", "li.age", "td.age"],
-        "height": ["dd.p-height", "span.height", "li.height", "td.height"],
-        "cup": ["dd.p-cup", "span.cup", "li.cup", "td.cup"],
-        "face_public": ["dd.p-face", "span.face", "li.face", "td.face"],
-    }
-
-    def pick_from_selectors(keys):
-        for sel in selectors[keys]:
-            tag = soup.select_one(sel)
-            if tag and text_content(tag):
-                return text_content(tag)
+    def pick_from_selectors(key: str) -> str:
+        for tag in soup.select(_FALLBACK_SEL[key]):
+            text = text_content(tag)
+            if text:
+                return text
         return ""
 
-    fields["age"] = first_non_empty(
-        fields["age"],
-        pick_from_selectors("age"),
-        find_labeled_value(soup, ["年齢", "歳", "才"]),
-    )
-    fields["height"] = first_non_empty(
-        fields["height"],
-        pick_from_selectors("height"),
-        find_labeled_value(soup, ["身長", "cm"]),
-    )
-    fields["cup"] = first_non_empty(
-        fields["cup"],
-        pick_from_selectors("cup"),
-        find_labeled_value(soup, ["カップ", "バスト"]),
-    )
-    fields["face_public"] = first_non_empty(
-        fields["face_public"],
-        pick_from_selectors("face_public"),
-        find_labeled_value(soup, ["顔出し", "顔", "公開"]),
-    )
+    # ラベル候補の走査はフォールバックが必要になった時に 1 度だけ行い、項目間で使い回す
+    candidates = None
+
+    def labeled(key: str) -> str:
+        nonlocal candidates
+        if candidates is None:
+            candidates = label_candidates(soup)
+        return find_labeled_value(candidates, LABEL_MAP[key])
+
+    for key in _FALLBACK_SEL:
+        fields[key] = fields[key] or pick_from_selectors(key) or labeled(key)
+
+    _DETAIL_CACHE.store(detail_url, resp, fields)
 
     return fields
 
 
-def post_to_wp(item: dict):
-    headers = {"X-API-KEY": API_KEY}
-    r = requests.post(API_URL, json=item, headers=headers, timeout=20)
-    r.raise_for_status()
-    print("Posted:", item["name"], r.text)
+def safe_parse_detail_page(detail_url: str) -> dict:
+    try:
+        return parse_detail_page(detail_url)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Detail fetch failed for {detail_url}: {exc}")
+        return {}
+
+
+def post_to_wp(item: dict) -> bool:
+    try:
+        r = _SESSION.post(API_URL, data=dump_json(item), headers=API_HEADERS, timeout=20)
+    except RequestException as exc:
+        print(f"Post failed for {item['name']} (status=no-status): {exc}")
+        return False
+
+    if r.ok:
+        print("Posted:", item["name"], r.status_code)
+        return True
+
+    print(f"Post failed for {item['name']} (status={r.status_code}): {r.text}")
+    return False
 
 
 def extract_background_image(style: str, base_url: str) -> str:
-    m = re.search(r"url\((.*?)\)", style or "")
-    if not m:
+    # 短い style 文字列なので正規表現を使わず url( と ) の位置で切り出す
+    style = style or ""
+    start = style.find("url(")
+    if start < 0:
+        return ""
+    end = style.find(")", start + 4)
+    if end < 0:
         return ""
-    return urljoin(base_url, m.group(1).strip("'\""))
+    return urljoin(base_url, style[start + 4:end].strip("'\""))
+
+
+# カードごとにセレクタ文字列を解釈し直さないよう、モジュール読み込み時に 1 度だけコンパイルする
+_CARD_PARTS_SEL = sv.compile("li.nick_name h3 b, li.taiki_comment, li.image span[style]")
+
+
+# 一覧ページはカードの li だけを木にする（ヘッダー・フッター等のノード生成を省く）
+# 解析中の class は "online-girl party" のような生の文字列で比較されるため、単語単位の正規表現で判定する
+_CARD_STRAINER = SoupStrainer("li", class_=re.compile(r"(?:^|\s)online-girl(?:\s|$)"))
+
+
+def find_card_parts(card) -> tuple:
+    """Collect the name, comment and thumbnail elements in one subtree walk."""
+
+    name_el = comment_el = image_span = None
+    for node in _CARD_PARTS_SEL.select(card):
+        if node.name == "b":
+            name_el = name_el or node
+        elif node.name == "span":
+            image_span = image_span or node
+        elif comment_el is None:
+            comment_el = node
+    return name_el, comment_el, image_span
 
 
 def scrape_jewel():
     base_url = os.environ.get("J_LIVE_BASE_URL", "https://www.j-live.tv/")
     html = fetch_html(base_url)
-    soup = BeautifulSoup(html, "html.parser")
-
-    items = []
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=_CARD_STRAINER)
 
+    # 同じプロフィールが複数枠に出ることがあるので、詳細 URL で重複を除いてから取得する
+    unique_anchors = {}
     for card in soup.select("li.online-girl.party"):
         a = card.find("a", href=True)
-        if not a:
-            continue
+        if a:
+            unique_anchors.setdefault(urljoin(base_url, a["href"]), a)
+
+    # 詳細ページは I/O 待ちが支配的なので並列で取得する
+    _DETAIL_CACHE.load()
+    with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as executor:
+        details = list(executor.map(safe_parse_detail_page, unique_anchors))
+    try:
+        _DETAIL_CACHE.save()
+    except OSError as exc:
+        print(f"Detail cache save failed: {exc}")
 
-        name_el = a.select_one("li.nick_name h3 b")
-        comment_el = a.select_one("li.taiki_comment")
-        image_span = a.select_one("li.image span[style]")
-        viewers_el = a.select_one("li.shityo span")
-        event_el = a.select_one("li.newface_str")
-
-        detail_url = urljoin(base_url, a["href"])
-        detail_fields = {}
+    items = []
 
-        try:
-            detail_fields = parse_detail_page(detail_url)
-        except Exception as exc:  # noqa: BLE001
-            print(f"Detail fetch failed for {detail_url}: {exc}")
+    for (detail_url, a), detail_fields in zip(unique_anchors.items(), details):
+        name_el, comment_el, image_span = find_card_parts(a)
 
         item = {
             "name": name_el.get_text(strip=True) if name_el else "",
@@ -227,16 +365,16 @@ def scrape_jewel():
             "hobby": detail_fields.get("hobby", ""),
             "favorite_type": detail_fields.get("favorite_type", ""),
             "erogenous_zone": detail_fields.get("erogenous_zone", ""),
-            "genre": first_non_empty(detail_fields.get("genre_detail", ""), "Jewel Live"),
+            "genre": detail_fields.get("genre_detail") or "Jewel Live",
         }
 
         items.append(item)
 
-    # WordPress API に送信
-    for item in items:
-        post_to_wp(item)
+    # WordPress API に送信（I/O 待ちなので並列で送り、接続はセッションのプールを共有）
+    with ThreadPoolExecutor(max_workers=POST_WORKERS) as executor:
+        success = sum(executor.map(post_to_wp, items))
 
-    print("完了：Jewel Live 送信数 →", len(items))
+    print("完了：Jewel Live 送信数 →", success)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,49 @@
+import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from urllib.parse import urljoin
 
 import requests
-from bs4 import BeautifulSoup
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer
+
+from detail_cache import DetailCache
+
+# lxml（C 実装）があれば使い、無ければ標準の html.parser にフォールバック
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# orjson があれば POST 本文のシリアライズに使う
+try:
+    import orjson
+
+    def dump_json(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def dump_json(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
 API_URL = os.environ.get("API_URL")
 API_KEY = os.environ.get("API_KEY")
+# API キーはスクレイピング先に送らないよう、セッション共通ヘッダーではなく POST 時のみ付与する
+API_HEADERS = {"X-API-KEY": API_KEY, "Content-Type": "application/json"}
+
+# 詳細ページ取得・API 送信の同時実行数
+DETAIL_WORKERS = 8
+POST_WORKERS = 8
+
+# 詳細ページの ETag / Last-Modified と解析結果を保存し、次回は条件付き GET で 304 なら再解析しない
+DETAIL_CACHE_PATH = os.environ.get("MADAM_LIVE_DETAIL_CACHE", "madam_detail_cache.json")
+# parse_detail_page の出力が変わる修正をしたら上げる（古い解析結果のキャッシュを捨てる）
+DETAIL_PARSER_VERSION = 1
 
 DEFAULT_HEADERS = {
     "User-Agent": (
@@ -15,6 +52,10 @@ DEFAULT_HEADERS = {
     )
 }
 
+_HAS_URL_RE = re.compile(r"url\(")
+_PROFILE_HREF_RE = re.compile(r"/profile|/cast|/live|/girls")
+_META_CHARSET_RE = re.compile(rb'charset=["\']?([\w\-]+)', re.I)
+
 
 def make_session() -> requests.Session:
     """Create a session that optionally ignores proxy env vars."""
@@ -29,42 +70,90 @@ def make_session() -> requests.Session:
     session.trust_env = trust_env
     if not trust_env:
         session.proxies = {}
+    session.headers.update(DEFAULT_HEADERS)
+
+    # keep-alive 接続をプールして一覧・詳細・POST で使い回す
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     return session
 
 
+_SESSION = make_session()
+
+
+def decode_html(resp: requests.Response) -> str:
+    """Decode a response body, running charset detection only as a last resort."""
+
+    # ヘッダーで charset が宣言されていればそれを信用する
+    if "charset=" in resp.headers.get("Content-Type", "").lower():
+        return resp.text
+    # 次に先頭 2KB の <meta charset> を見る
+    m = _META_CHARSET_RE.search(resp.content[:2048])
+    if m:
+        try:
+            return resp.content.decode(m.group(1).decode("ascii"), "replace")
+        except LookupError:
+            pass
+    try:
+        return resp.content.decode("utf-8")
+    except UnicodeDecodeError:
+        if resp.apparent_encoding:
+            resp.encoding = resp.apparent_encoding
+        return resp.text
+
+
 def fetch_html(url: str) -> str:
-    session = make_session()
-    resp = session.get(url, headers=DEFAULT_HEADERS, timeout=20)
+    resp = _SESSION.get(url, timeout=20)
     resp.raise_for_status()
-    return resp.text
+    return decode_html(resp)
 
 
-def text_content(tag) -> str:
-    return tag.get_text(" ", strip=True) if tag else ""
+_DETAIL_CACHE = DetailCache(DETAIL_CACHE_PATH, DETAIL_PARSER_VERSION)
 
 
-def first_non_empty(*values: str) -> str:
-    for value in values:
-        if value:
-            return value
-    return ""
+def text_content(tag) -> str:
+    if tag is None:
+        return ""
+    # 文字列 1 つだけを持つ葉要素（dd/td など）は get_text の走査を省く
+    contents = tag.contents
+    if len(contents) == 1 and type(contents[0]) is NavigableString:
+        return contents[0].strip()
+    return tag.get_text(" ", strip=True)
 
 
 def extract_background_image(style: str, base_url: str) -> str:
-    m = re.search(r"url\((.*?)\)", style or "")
-    if not m:
+    # 短い style 文字列なので正規表現を使わず url( と ) の位置で切り出す
+    style = style or ""
+    start = style.find("url(")
+    if start < 0:
+        return ""
+    end = style.find(")", start + 4)
+    if end < 0:
         return ""
-    return urljoin(base_url, m.group(1).strip("'\""))
+    return urljoin(base_url, style[start + 4:end].strip("'\""))
+
+
+_LABEL_CANDIDATE_SEL = "dt, th, label, strong, b"
+
+
+@lru_cache(maxsize=None)
+def keyword_pattern(keywords: tuple) -> re.Pattern:
+    return re.compile("|".join(map(re.escape, keywords)))
 
 
-def find_labeled_value(soup: BeautifulSoup, keywords: list[str]) -> str:
-    def matches(tag):
-        if not getattr(tag, "get_text", None):
-            return False
-        text = tag.get_text(strip=True)
-        return any(key in text for key in keywords)
+def label_candidates(soup: BeautifulSoup) -> list[tuple[str, object]]:
+    # 全ノードに Python の判定関数を当てず、ラベルになり得る要素だけをテキストと組で 1 度集める
+    return [(node.get_text(strip=True), node) for node in soup.select(_LABEL_CANDIDATE_SEL)]
 
-    label = soup.find(matches)
+
+def find_labeled_value(candidates: list[tuple[str, object]], keywords: list[str]) -> str:
+    pattern = keyword_pattern(tuple(keywords))
+    label = next((node for text, node in candidates if pattern.search(text)), None)
     if not label:
         return ""
 
@@ -83,11 +172,54 @@ def find_labeled_value(soup: BeautifulSoup, keywords: list[str]) -> str:
     return text_content(sibling)
 
 
+_PROFILE_SEL = ".profile, .cast-profile, .profile-box"
+_TAG_SEL = ".tag, .genre, .badge"
+
+# 項目ごとのフォールバック用セレクタ（プロフィール枠で取れなかった項目だけページ全体から探す）
+_FALLBACK_SEL = {
+    "age": ".age",
+    "height": ".height",
+    "cup": ".cup",
+    "face_public": ".face",
+}
+
+LABEL_MAP = {
+    "age": ["年齢", "歳", "才"],
+    "height": ["身長", "cm"],
+    "cup": ["カップ", "バスト"],
+    "face_public": ["顔出し", "顔", "公開"],
+    "toy": ["おもちゃ", "玩具"],
+    "time_slot": ["出没時間", "時間"],
+    "style": ["スタイル"],
+    "job": ["職業"],
+    "hobby": ["趣味"],
+    "favorite_type": ["好みのタイプ", "好きなタイプ"],
+    "erogenous_zone": ["性感帯"],
+    "genre_detail": ["ジャンル", "タイプ"],
+}
+
+
+@lru_cache(maxsize=256)
+def label_field(label: str) -> str | None:
+    # 項目名 → フィールド名。LABEL_MAP の定義順で最初に該当した項目を採る
+    # （「バスト(cm)」は先に並ぶ身長の "cm" に該当する）。同じ項目名はページ間で繰り返し出るので結果を使い回す
+    for field, keywords in LABEL_MAP.items():
+        if any(key in label for key in keywords):
+            return field
+    return None
+
+
 def parse_detail_page(detail_url: str) -> dict:
     """Parse detail page fields from Madam Live profiles."""
 
-    html = fetch_html(detail_url)
-    soup = BeautifulSoup(html, "html.parser")
+    headers = _DETAIL_CACHE.request_headers(detail_url)
+    resp = _SESSION.get(detail_url, headers=headers, timeout=20)
+    if resp.status_code == 304:
+        cached = _DETAIL_CACHE.cached_fields(detail_url)
+        if cached is not None:
+            return cached
+    resp.raise_for_status()
+    soup = BeautifulSoup(decode_html(resp), HTML_PARSER)
 
     fields = {
         "age": "",
@@ -104,22 +236,7 @@ def parse_detail_page(detail_url: str) -> dict:
         "genre_detail": "",
     }
 
-    label_map = {
-        "age": ["年齢", "歳", "才"],
-        "height": ["身長", "cm"],
-        "cup": ["カップ", "バスト"],
-        "face_public": ["顔出し", "顔", "公開"],
-        "toy": ["おもちゃ", "玩具"],
-        "time_slot": ["出没時間", "時間"],
-        "style": ["スタイル"],
-        "job": ["職業"],
-        "hobby": ["趣味"],
-        "favorite_type": ["好みのタイプ", "好きなタイプ"],
-        "erogenous_zone": ["性感帯"],
-        "genre_detail": ["ジャンル", "タイプ"],
-    }
-
-    profile_container = soup.select_one(".profile, .cast-profile, .profile-box")
+    profile_container = soup.select_one(_PROFILE_SEL)
     if profile_container:
         for dl in profile_container.select("dl"):
             dt = dl.find("dt")
@@ -129,10 +246,9 @@ def parse_detail_page(detail_url: str) -> dict:
             if not label:
                 continue
 
-            for field, keywords in label_map.items():
-                if any(key in label for key in keywords):
-                    fields[field] = value
-                    break
+            field = label_field(label)
+            if field:
+                fields[field] = value
 
         for table in profile_container.select("table"):
             for row in table.select("tr"):
@@ -142,42 +258,62 @@ def parse_detail_page(detail_url: str) -> dict:
                 value = text_content(td)
                 if not label:
                     continue
-                for field, keywords in label_map.items():
-                    if any(key in label for key in keywords):
-                        fields[field] = value
-                        break
+                field = label_field(label)
+                if field:
+                    fields[field] = value
 
-        genre_tags = [text_content(tag) for tag in profile_container.select(".tag, .genre, .badge")]
+        genre_tags = [text_content(tag) for tag in profile_container.select(_TAG_SEL)]
         genre_tags = [g for g in genre_tags if g]
         if genre_tags:
             fields["genre_detail"] = ", ".join(genre_tags)
 
-    selectors = {
-        "age": [".age", "span.age", "li.age", "td.age"],
-        "height": [".height", "span.height", "li.height", "td.height"],
-        "cup": [".cup", "span.cup", "li.cup", "td.cup"],
-        "face_public": [".face", "span.face", "li.face", "td.face"],
-    }
-
     def pick_from_selectors(key: str) -> str:
-        for sel in selectors[key]:
-            tag = soup.select_one(sel)
-            if tag and text_content(tag):
-                return text_content(tag)
+        for tag in soup.select(_FALLBACK_SEL[key]):
+            text = text_content(tag)
+            if text:
+                return text
         return ""
 
-    fields["age"] = first_non_empty(fields["age"], pick_from_selectors("age"), find_labeled_value(soup, label_map["age"]))
-    fields["height"] = first_non_empty(
-        fields["height"], pick_from_selectors("height"), find_labeled_value(soup, label_map["height"])
-    )
-    fields["cup"] = first_non_empty(fields["cup"], pick_from_selectors("cup"), find_labeled_value(soup, label_map["cup"]))
-    fields["face_public"] = first_non_empty(
-        fields["face_public"], pick_from_selectors("face_public"), find_labeled_value(soup, label_map["face_public"])
-    )
+    # ラベル候補の走査はフォールバックが必要になった時に 1 度だけ行い、項目間で使い回す
+    candidates = None
+
+    def labeled(key: str) -> str:
+        nonlocal candidates
+        if candidates is None:
+            candidates = label_candidates(soup)
+        return find_labeled_value(candidates, LABEL_MAP[key])
+
+    for key in _FALLBACK_SEL:
+        fields[key] = fields[key] or pick_from_selectors(key) or labeled(key)
+
+    _DETAIL_CACHE.store(detail_url, resp, fields)
 
     return fields
 
 
+def safe_parse_detail_page(detail_url: str) -> dict:
+    try:
+        return parse_detail_page(detail_url)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Detail fetch failed for {detail_url}: {exc}")
+        return {}
+
+
+def post_to_wp(item: dict) -> bool:
+    try:
+        r = _SESSION.post(API_URL, data=dump_json(item), headers=API_HEADERS, timeout=20)
+    except RequestException as exc:
+        print(f"Post failed for {item['name']} (status=no-status): {exc}")
+        return False
+
+    if r.ok:
+        print("Posted:", item["name"], r.status_code)
+        return True
+
+    print(f"Post failed for {item['name']} (status={r.status_code}): {r.text}")
+    return False
+
+
 def extract_card_info(card, base_url: str) -> dict:
     name_el = card.select_one(
         ".name, .nickname, .user_name, .user-name, .nick, .nick_name, h3, h4, p.name, .live-name, "
@@ -193,7 +329,7 @@ def extract_card_info(card, base_url: str) -> dict:
     if image_tag:
         thumb = image_tag.get("src") or image_tag.get("data-src") or image_tag.get("data-original", "")
     if not thumb:
-        style_holder = card.find(attrs={"style": re.compile("url\(")})
+        style_holder = card.find(attrs={"style": _HAS_URL_RE})
         if style_holder:
             thumb = extract_background_image(style_holder.get("style", ""), base_url)
     if thumb:
@@ -210,48 +346,70 @@ def extract_card_info(card, base_url: str) -> dict:
     }
 
 
+# カード候補のセレクタ（上から順に試し、最初に見つかったものを使う）
+_CARD_SELECTORS = [
+    "div.cast-box",  # common card container
+    "li.cast",  # list item cards
+    "div.card",  # generic cards
+    "dl.onlinegirl-dl-big",  # Madam Live desktop cards
+    "dl.onlinegirl-dl",  # Madam Live small cards
+    "dl[id^='stat_']",  # Madam Live fallback dl cards
+    "section a[href]",  # fallback anchors
+]
+# クラス指定のカード（先頭 5 つ）になり得る要素だけを木にする。
+# 解析中の class は "onlinegirl-dl-big on" のような生の文字列で比較されるため、単語単位の正規表現で判定する
+_CARD_STRAINER = SoupStrainer(
+    ["div", "li", "dl"],
+    class_=re.compile(r"(?:^|\s)(?:cast-box|cast|card|onlinegirl-dl-big|onlinegirl-dl)(?:\s|$)"),
+)
+
+
+def select_cards(soup: BeautifulSoup, selectors: list[str]) -> list:
+    for selector in selectors:
+        cards = soup.select(selector)
+        if cards:
+            return cards
+    return []
+
+
 def scrape_madam():
     env_base_url = os.environ.get("MADAM_LIVE_BASE_URL", "https://www.madamlive.tv/")
     base_url = env_base_url.strip() or "https://www.madamlive.tv/"
     html = fetch_html(base_url)
-    soup = BeautifulSoup(html, "html.parser")
-
-    cards = []
-    for selector in [
-        "div.cast-box",  # common card container
-        "li.cast",  # list item cards
-        "div.card",  # generic cards
-        "dl.onlinegirl-dl-big",  # Madam Live desktop cards
-        "dl.onlinegirl-dl",  # Madam Live small cards
-        "dl[id^='stat_']",  # Madam Live fallback dl cards
-        "section a[href]",  # fallback anchors
-    ]:
-        cards = soup.select(selector)
-        if cards:
-            break
+
+    # 通常はカード要素だけを解析し、見つからない場合は全体を解析してセレクタを最初から試し直す
+    strained = BeautifulSoup(html, HTML_PARSER, parse_only=_CARD_STRAINER)
+    cards = select_cards(strained, _CARD_SELECTORS[:5])
     if not cards:
-        cards = soup.find_all("a", href=re.compile(r"/profile|/cast|/live|/girls"))
+        soup = BeautifulSoup(html, HTML_PARSER)
+        cards = select_cards(soup, _CARD_SELECTORS) or soup.find_all("a", href=_PROFILE_HREF_RE)
 
     seen = set()
-    items = []
-
+    infos = []
     for card in cards:
         info = extract_card_info(card, base_url)
         detail_url = info.get("url")
         if not detail_url or detail_url in seen:
             continue
         seen.add(detail_url)
+        infos.append(info)
 
-        detail_fields = {}
-        try:
-            detail_fields = parse_detail_page(detail_url)
-        except Exception as exc:  # noqa: BLE001
-            print(f"Detail fetch failed for {detail_url}: {exc}")
+    # 詳細ページは I/O 待ちが支配的なので並列で取得する
+    _DETAIL_CACHE.load()
+    with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as executor:
+        details = list(executor.map(safe_parse_detail_page, [info["url"] for info in infos]))
+    try:
+        _DETAIL_CACHE.save()
+    except OSError as exc:
+        print(f"Detail cache save failed: {exc}")
+
+    items = []
 
+    for info, detail_fields in zip(infos, details):
         item = {
             "name": info["name"],
             "samune": info["samune"],
-            "url": detail_url,
+            "url": info["url"],
             "oneword": info["oneword"],
             "age": detail_fields.get("age", ""),
             "height": detail_fields.get("height", ""),
@@ -264,18 +422,16 @@ def scrape_madam():
             "hobby": detail_fields.get("hobby", ""),
             "favorite_type": detail_fields.get("favorite_type", ""),
             "erogenous_zone": detail_fields.get("erogenous_zone", ""),
-            "genre": first_non_empty(detail_fields.get("genre_detail", ""), "Madam Live"),
+            "genre": detail_fields.get("genre_detail") or "Madam Live",
         }
 
         items.append(item)
 
-    headers = {"X-API-KEY": API_KEY}
-    for item in items:
-        r = requests.post(API_URL, json=item, headers=headers, timeout=20)
-        r.raise_for_status()
-        print("Posted:", item["name"], r.text)
+    # POST も I/O 待ちなので並列で送信（接続はセッションのプールを共有）
+    with ThreadPoolExecutor(max_workers=POST_WORKERS) as executor:
+        success = sum(executor.map(post_to_wp, items))
 
-    print("完了：Madam Live 送信数 →", len(items))
+    print("完了：Madam Live 送信数 →", success)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# スクリプトはパッケージ化されていないので、リポジトリ直下を import パスに加える
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
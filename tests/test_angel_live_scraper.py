@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("requests")
+
+import angel_live_scraper as angel
+from detail_cache import DetailCache
+
+DETAIL_URL = "https://www.angel-live.com/profile/1"
+DETAIL_HTML = """
+<html><body>
+<div class="profile">
+  <dl><dt>身長</dt><dd>160</dd></dl>
+  <dl><dt>職業</dt><dd>学生</dd></dl>
+</div>
+</body></html>
+"""
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, text=""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+        self.content = text.encode("utf-8")
+
+    def raise_for_status(self):
+        pass
+
+
+def test_not_modified_detail_page_returns_cached_fields(monkeypatch, tmp_path):
+    path = str(tmp_path / "angel_detail_cache.json")
+    monkeypatch.setattr(angel, "_DETAIL_CACHE", DetailCache(path, angel.DETAIL_PARSER_VERSION))
+    responses = [
+        FakeResponse(200, {"Content-Type": "text/html; charset=utf-8", "ETag": '"v1"'}, DETAIL_HTML),
+        FakeResponse(304),
+    ]
+    sent = []
+
+    def fake_get(url, headers=None, timeout=None):
+        sent.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr(angel._SESSION, "get", fake_get)
+
+    first = angel.parse_detail_page(DETAIL_URL)
+    angel._DETAIL_CACHE.save()
+
+    # 次回の実行を想定し、保存したファイルから読み直してから 304 を返す
+    monkeypatch.setattr(angel, "_DETAIL_CACHE", DetailCache(path, angel.DETAIL_PARSER_VERSION))
+    angel._DETAIL_CACHE.load()
+    second = angel.parse_detail_page(DETAIL_URL)
+
+    assert first["height"] == "160"
+    assert first["job"] == "学生"
+    assert second == first
+    assert sent == [{}, {"If-None-Match": '"v1"'}]
@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("requests")
+pytest.importorskip("playwright")
+
+import chatpia_scraper_playwright as chatpia
+
+
+def test_label_field_follows_keyword_order():
+    # 複数のキーワードを含む項目名は _KW_TO_KEY で先に並ぶ項目になる
+    assert chatpia.label_field("職業・身長") == "height"
+    assert chatpia.label_field("スリーサイズ") == "cup"
+    assert chatpia.label_field("その他") is None
@@ -0,0 +1,51 @@
+import json
+
+from detail_cache import DetailCache
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_validators_round_trip(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = DetailCache(path, 1)
+    assert cache.request_headers("https://example.com/a") == {}
+    cache.store("https://example.com/a", FakeResponse({"ETag": '"v1"'}), {"height": "160"})
+    cache.save()
+
+    reloaded = DetailCache(path, 1)
+    reloaded.load()
+    assert reloaded.request_headers("https://example.com/a") == {"If-None-Match": '"v1"'}
+    assert reloaded.cached_fields("https://example.com/a") == {"height": "160"}
+
+
+def test_other_parser_version_is_ignored(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = DetailCache(path, 1)
+    cache.request_headers("https://example.com/a")
+    cache.store("https://example.com/a", FakeResponse({"ETag": '"v1"'}), {"height": "160"})
+    cache.save()
+
+    reloaded = DetailCache(path, 2)
+    reloaded.load()
+    assert reloaded.request_headers("https://example.com/a") == {}
+    assert reloaded.cached_fields("https://example.com/a") is None
+
+
+def test_save_keeps_only_urls_handled_this_run(tmp_path):
+    path = tmp_path / "cache.json"
+    entry = {"etag": '"v1"', "last_modified": None, "fields": {}}
+    path.write_text(json.dumps({
+        "parser_version": 1,
+        "entries": {"https://example.com/a": entry, "https://example.com/gone": entry},
+    }), encoding="utf-8")
+
+    cache = DetailCache(str(path), 1)
+    cache.load()
+    cache.request_headers("https://example.com/a")
+    cache.save()
+
+    saved = json.loads(path.read_text(encoding="utf-8"))
+    assert list(saved["entries"]) == ["https://example.com/a"]
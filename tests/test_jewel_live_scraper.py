@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("requests")
+
+import jewel_live_scraper as jewel
+from detail_cache import DetailCache
+
+LISTING_HTML = """
+<html><body>
+<header><a href="/login">login</a></header>
+<ul>
+  <li class="online-girl party">
+    <a href="/profile/123">
+      <ul>
+        <li class="image"><span style="background-image:url('/img/123.jpg')"></span></li>
+        <li class="nick_name"><h3><b>さくら</b></h3></li>
+        <li class="taiki_comment">こんばんは</li>
+      </ul>
+    </a>
+  </li>
+</ul>
+</body></html>
+"""
+
+
+def test_scrape_jewel_keeps_multi_class_cards(monkeypatch):
+    posted = []
+    monkeypatch.setenv("J_LIVE_BASE_URL", "https://www.j-live.tv/")
+    monkeypatch.setattr(jewel, "fetch_html", lambda url: LISTING_HTML)
+    monkeypatch.setattr(jewel, "safe_parse_detail_page", lambda url: {})
+    monkeypatch.setattr(jewel._DETAIL_CACHE, "load", lambda: None)
+    monkeypatch.setattr(jewel._DETAIL_CACHE, "save", lambda: None)
+    monkeypatch.setattr(jewel, "post_to_wp", lambda item: posted.append(item) or True)
+
+    jewel.scrape_jewel()
+
+    assert len(posted) == 1
+    item = posted[0]
+    assert item["name"] == "さくら"
+    assert item["url"] == "https://www.j-live.tv/profile/123"
+    assert item["samune"] == "https://www.j-live.tv/img/123.jpg"
+    assert item["oneword"] == "こんばんは"
+
+
+def test_label_field_follows_label_map_order():
+    # 複数の項目に該当する項目名は LABEL_MAP で先に並ぶ項目になる
+    assert jewel.label_field("バスト(cm)") == "height"
+    assert jewel.label_field("カップ") == "cup"
+    assert jewel.label_field("出没時間") == "time_slot"
+    assert jewel.label_field("その他") is None
+
+
+DETAIL_URL = "https://www.j-live.tv/profile/123"
+DETAIL_HTML = """
+<html><body>
+<div class="profile-box">
+  <dl class="profile-dl"><dt>身長</dt><dd>160</dd></dl>
+  <dl class="profile-dl"><dt>職業</dt><dd>学生</dd></dl>
+</div>
+</body></html>
+"""
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, text=""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+        self.content = text.encode("utf-8")
+
+    def raise_for_status(self):
+        pass
+
+
+def test_not_modified_detail_page_returns_cached_fields(monkeypatch, tmp_path):
+    path = str(tmp_path / "detail_cache.json")
+    monkeypatch.setattr(jewel, "_DETAIL_CACHE", DetailCache(path, jewel.DETAIL_PARSER_VERSION))
+    responses = [
+        FakeResponse(200, {"Content-Type": "text/html; charset=utf-8", "ETag": '"v1"'}, DETAIL_HTML),
+        FakeResponse(304),
+    ]
+    sent = []
+
+    def fake_get(url, headers=None, timeout=None):
+        sent.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr(jewel._SESSION, "get", fake_get)
+
+    first = jewel.parse_detail_page(DETAIL_URL)
+    jewel._DETAIL_CACHE.save()
+
+    # 次回の実行を想定し、保存したファイルから読み直してから 304 を返す
+    monkeypatch.setattr(jewel, "_DETAIL_CACHE", DetailCache(path, jewel.DETAIL_PARSER_VERSION))
+    jewel._DETAIL_CACHE.load()
+    second = jewel.parse_detail_page(DETAIL_URL)
+
+    assert first["height"] == "160"
+    assert first["job"] == "学生"
+    assert second == first
+    assert sent == [{}, {"If-None-Match": '"v1"'}]
@@ -0,0 +1,80 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("requests")
+pytest.importorskip("gspread")
+
+import update_sheet
+
+
+def test_detail_requests_are_spaced_across_threads(monkeypatch):
+    monkeypatch.setattr(update_sheet, "DETAIL_MAX_RPS", 20.0)
+    monkeypatch.setattr(update_sheet, "_next_request_at", 0.0)
+    started = []
+    monkeypatch.setattr(update_sheet, "fetch_html", lambda url: started.append(time.monotonic()))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(update_sheet.fetch_detail_html, ["u"] * 5))
+
+    started.sort()
+    gaps = [b - a for a, b in zip(started, started[1:])]
+    # 4 並列でも 1 / 20 秒以上ずつ間隔が空く（タイマー誤差を少しだけ許容する）
+    assert all(gap >= 0.045 for gap in gaps)
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, text=""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+        self.content = text.encode("utf-8")
+
+    def raise_for_status(self):
+        pass
+
+
+def use_listing_meta(monkeypatch, tmp_path, spreadsheet_id="sheet-a", sheet_name="live"):
+    monkeypatch.setattr(update_sheet, "LISTING_META_CACHE", str(tmp_path / "listing_meta.json"))
+    monkeypatch.setattr(update_sheet, "LISTING_URL", "https://example.com/listing")
+    monkeypatch.setattr(update_sheet, "SPREADSHEET_ID", spreadsheet_id)
+    monkeypatch.setattr(update_sheet, "SHEET_NAME", sheet_name)
+
+
+def test_unchanged_listing_stops_before_opening_the_sheet(monkeypatch, tmp_path):
+    use_listing_meta(monkeypatch, tmp_path)
+    update_sheet.save_listing_meta(FakeResponse(200, {"ETag": '"v1"'}))
+
+    sent = []
+
+    def fake_get(url, headers=None, timeout=None):
+        sent.append(headers)
+        return FakeResponse(304)
+
+    def fail_open_sheet():
+        raise AssertionError("sheet must not be opened on 304")
+
+    monkeypatch.setattr(update_sheet._SESSION, "get", fake_get)
+    monkeypatch.setattr(update_sheet, "open_sheet", fail_open_sheet)
+
+    update_sheet.main()
+
+    assert sent == [{"If-None-Match": '"v1"'}]
+
+
+@pytest.mark.parametrize("changed", ["LISTING_URL", "SPREADSHEET_ID", "SHEET_NAME"])
+def test_listing_meta_is_ignored_when_the_target_changes(monkeypatch, tmp_path, changed):
+    use_listing_meta(monkeypatch, tmp_path)
+    update_sheet.save_listing_meta(
+        FakeResponse(200, {"ETag": '"v1"', "Last-Modified": "Wed, 14 Oct 2026 00:00:00 GMT"})
+    )
+    assert update_sheet.load_listing_meta() == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Wed, 14 Oct 2026 00:00:00 GMT",
+    }
+
+    monkeypatch.setattr(update_sheet, changed, "other")
+
+    assert update_sheet.load_listing_meta() == {}
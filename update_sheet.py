@@ -2,17 +2,62 @@ import os
 import json
 import base64
 import re
-from urllib.parse import urljoin
-import time  ### 変更点：timeモジュールをインポート
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urljoin, urlsplit
 
 import requests
-from bs4 import BeautifulSoup
+import soupsieve as sv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
 import gspread
 
+# lxml（C 実装）があれば使い、無ければ標準の html.parser にフォールバック
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
 SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID", "YOUR_SPREADSHEET_ID")
 SHEET_NAME = os.environ.get("SHEET_NAME", "live")
 LISTING_URL = os.environ.get("LISTING_URL", "https://example.com/listing")
 
+# 詳細ページ取得の同時実行数
+DETAIL_WORKERS = 8
+
+# 相手サーバーに配慮し、詳細ページへのリクエストは並列でも全体で毎秒この回数までに抑える
+# （以前は 1 件ごとに 1.5 秒待機していた。同時実行数の上限だけでは毎秒の回数は抑えられない）
+DETAIL_MAX_RPS = float(os.environ.get("DETAIL_MAX_RPS", "1"))
+
+# 詳細ページの dd.p-xxx から拾う項目（xxx の部分）
+DETAIL_KEYS = frozenset({
+    'age', 'height', 'cup', 'face', 'toy', 'appear',
+    'style', 'job', 'hobby', 'favor', 'seikantai',
+})
+
+# 一覧ページの ETag / Last-Modified を保存し、次回は条件付き GET で 304 なら何もしない
+LISTING_META_CACHE = os.environ.get("LISTING_META_CACHE", "listing_meta.json")
+
+# シートの A〜D 列の並び（名前・画像・URL・コメント）に合わせた一覧の 1 件分
+ListingEntry = namedtuple('ListingEntry', 'name image url comment')
+
+# 一覧ページで必要なのはリンク配下のカードだけなので、それ以外は木を組み立てない
+_LISTING_STRAINER = SoupStrainer('a', href=True)
+
+# 一覧のアンカーごとに使うセレクタは事前にコンパイルしておく
+_NAME_SEL = sv.compile('h3 > b.bold')
+_IMAGE_SEL = sv.compile('li.image span[style]')
+_COMMENT_SEL = sv.compile('li.taiki_comment')
+
+_STYLE_URL_RE = re.compile(r"url\(([^)]*)\)")
+_META_CHARSET_RE = re.compile(rb'charset=["\']?([\w\-]+)', re.I)
+
 
 def get_gspread_client():
     b64 = os.environ.get("GSHEET_JSON")
@@ -28,128 +73,251 @@ def open_sheet():
     return sh.worksheet(SHEET_NAME)
 
 
-### 変更点：fetch_html関数を修正 ###
-def fetch_html(url):
+def make_session():
+    session = requests.Session()
     # ブラウザからのアクセスを装うためのヘッダー情報
-    headers = {
+    session.headers.update({
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
-    }
+    })
+    # keep-alive 接続をプールし、一覧・詳細ページの取得で使い回す
+    adapter = HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_SESSION = make_session()
+
+
+def decode_html(resp):
+    # ヘッダー → 先頭 2KB の <meta charset> → UTF-8 の順に試し、文字コード推定は最後の手段にする
+    if 'charset=' in resp.headers.get('Content-Type', '').lower():
+        return resp.text
+    m = _META_CHARSET_RE.search(resp.content[:2048])
+    if m:
+        try:
+            return resp.content.decode(m.group(1).decode('ascii'), 'replace')
+        except LookupError:
+            pass
+    try:
+        return resp.content.decode('utf-8')
+    except UnicodeDecodeError:
+        if resp.apparent_encoding:
+            resp.encoding = resp.apparent_encoding
+        return resp.text
+
+
+_RATE_LOCK = threading.Lock()
+_next_request_at = 0.0
+
+
+def wait_for_rate_limit():
+    # 次にリクエストしてよい時刻を全スレッドで共有し、1 / DETAIL_MAX_RPS 秒ずつ間隔を空ける
+    global _next_request_at
+    with _RATE_LOCK:
+        now = time.monotonic()
+        start = max(now, _next_request_at)
+        _next_request_at = start + 1 / DETAIL_MAX_RPS
+    if start > now:
+        time.sleep(start - now)
+
+
+def fetch_detail_html(url):
+    wait_for_rate_limit()
+    return fetch_html(url)
+
+
+### 変更点：fetch_html関数を修正 ###
+def fetch_html(url):
     try:
-        # ヘッダー情報を付けてアクセスし、タイムアウトを20秒に設定
-        resp = requests.get(url, headers=headers, timeout=20)
+        # 共有セッションでアクセスし、タイムアウトを20秒に設定
+        resp = _SESSION.get(url, timeout=20)
         # 正常なレスポンス（200 OKなど）以外の場合はエラーを発生させる
         resp.raise_for_status()
-        return resp.text
+        return decode_html(resp)
     except requests.exceptions.RequestException as e:
         # 接続エラーやタイムアウトなどが発生した場合は、エラーメッセージを表示してNoneを返す
         print(f"Error fetching {url}: {e}")
         return None
 
 
+@lru_cache(maxsize=8)
+def split_base_url(base_url):
+    return urlsplit(base_url)
+
+
+def join_url(base_url, href):
+    # 絶対 URL・スキーム相対・ルート相対はベース URL の再解析なしで組み立てる
+    if href.startswith(('http://', 'https://')):
+        return href
+    base = split_base_url(base_url)
+    if href.startswith('//'):
+        return f'{base.scheme}:{href}'
+    if href.startswith('/'):
+        return f'{base.scheme}://{base.netloc}{href}'
+    return urljoin(base_url, href)
+
+
+def listing_meta_key():
+    # 検証子は一覧 URL だけでなく書き込み先のシートにも紐づける（シートを替えたら 304 で止まらないように）
+    return {'url': LISTING_URL, 'spreadsheet_id': SPREADSHEET_ID, 'sheet_name': SHEET_NAME}
+
+
+def load_listing_meta():
+    try:
+        with open(LISTING_META_CACHE, encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # 一覧 URL・スプレッドシート・シート名のどれかが前回と違えば検証子は使わない
+    if not isinstance(meta, dict) or any(meta.get(k) != v for k, v in listing_meta_key().items()):
+        return {}
+    return meta.get('headers') or {}
+
+
+def save_listing_meta(resp):
+    headers = {}
+    if resp.headers.get('ETag'):
+        headers['If-None-Match'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified'):
+        headers['If-Modified-Since'] = resp.headers['Last-Modified']
+    tmp = LISTING_META_CACHE + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({**listing_meta_key(), 'headers': headers}, f)
+    os.replace(tmp, LISTING_META_CACHE)
+
+
+def fetch_listing():
+    try:
+        # 前回の検証子を付けて取得する（変化が無ければ本文なしの 304 が返る）
+        resp = _SESSION.get(LISTING_URL, headers=load_listing_meta(), timeout=20)
+        resp.raise_for_status()
+        return resp
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching {LISTING_URL}: {e}")
+        return None
+
+
 def parse_listing(html, base_url):
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=_LISTING_STRAINER)
     entries = []
-    for a in soup.select('a[href]'):
-        if not a.select_one('h3 > b.bold'):
+    for a in soup.find_all('a', href=True):
+        name_tag = _NAME_SEL.select_one(a)
+        if not name_tag:
             continue
-        name = a.select_one('h3 > b.bold').get_text(strip=True)
-        url = a['href']
-        if not url.startswith('http'):
-            url = urljoin(base_url, url)
+        name = name_tag.get_text(strip=True)
+        url = join_url(base_url, a['href'])
         img = ''
-        img_span = a.select_one('li.image span[style]')
+        img_span = _IMAGE_SEL.select_one(a)
         if img_span:
-            m = re.search(r"url\((.*?)\)", img_span['style'])
+            m = _STYLE_URL_RE.search(img_span['style'])
             if m:
-                img = urljoin(base_url, m.group(1).strip("'\""))
+                img = join_url(base_url, m.group(1).strip("'\""))
         comment = ''
-        comment_tag = a.select_one('li.taiki_comment')
+        comment_tag = _COMMENT_SEL.select_one(a)
         if comment_tag:
             comment = comment_tag.get_text(strip=True)
-        entries.append({'name': name, 'url': url, 'image': img, 'comment': comment})
+        entries.append(ListingEntry(name, img, url, comment))
     return entries
 
 
 def parse_detail(html):
-    soup = BeautifulSoup(html, 'html.parser')
-
-    def text(sel):
-        tag = soup.select_one(sel)
-        return tag.get_text(strip=True) if tag else ''
-
-    detail = {
-        'age': text('dd.p-age'),
-        'height': text('dd.p-height'),
-        'cup': text('dd.p-cup'),
-        'face': text('dd.p-face'),
-        'toy': text('dd.p-toy'),
-        'appear': text('dd.p-appear'),
-        'style': text('dd.p-style'),
-        'job': text('dd.p-job'),
-        'hobby': text('dd.p-hobby'),
-        'favor': text('dd.p-favor'),
-        'seikantai': text('dd.p-seikantai'),
-    }
+    soup = BeautifulSoup(html, HTML_PARSER)
+
+    # dd.p-xxx をクラス名ごとに 11 回探さず、dd を 1 度だけ走査して振り分ける（同じ項目は先頭を優先）
+    detail = {}
+    for dd in soup.find_all('dd', class_=True):
+        for cls in dd.get('class') or ():
+            key = cls[2:]
+            if cls.startswith('p-') and key in DETAIL_KEYS and key not in detail:
+                detail[key] = dd.get_text(strip=True)
+    for key in DETAIL_KEYS:
+        detail.setdefault(key, '')
+
     genres = [div.get_text(strip=True) for div in soup.select('dd.genre-list div.genre-div')]
     detail['genre'] = ','.join(genres)
     return detail
 
 
+def append_new_rows(ws, rows):
+    if not rows:
+        print("No new items to add.")
+        return
+
+    # 1 行ずつ append_row すると行数分の API 呼び出しになるため、まとめて 1 回で追記する
+    # ③ 追記時は必ず A1:P1 をテーブル起点に指定（←これが肝）
+    ws.append_rows(
+        rows,
+        value_input_option="USER_ENTERED",
+        table_range="A1:P1"   # ★ ここを指定することでW列起点問題を回避
+    )
+    print(f"Added {len(rows)} rows.")
+
+
 def main():
-    ws = open_sheet()
-    existing = set(ws.col_values(3))  # column C
-    
     print(f"Fetching listing page: {LISTING_URL}")
-    listing_html = fetch_html(LISTING_URL)
-    if not listing_html:
+    listing_resp = fetch_listing()
+    if listing_resp is None:
         print("Failed to get listing page. Aborting.")
         return
+    if listing_resp.status_code == 304:
+        print("Listing page not modified since the last complete run. Nothing to do.")
+        return
+    listing_html = decode_html(listing_resp)
+
+    ws = open_sheet()
+    # 見出し行を除いた C 列（URL）だけを、行ごとの配列ではなく 1 本の列として取得する
+    columns = ws.get('C2:C', major_dimension='COLUMNS')
+    existing = set(columns[0]) if columns else set()
+    existing.discard('')
 
     items = parse_listing(listing_html, LISTING_URL)
     print(f"Found {len(items)} items on the listing page.")
 
-    for item in items:
-        if item['url'] in existing:
-            continue
-            
-        print(f"Fetching detail page: {item['url']}")
-        detail_html = fetch_html(item['url'])
-        
-        ### 変更点：詳細ページの取得に失敗した場合の処理を追加 ###
-        if not detail_html:
-            print(f"Skipping {item['name']} because detail page could not be fetched.")
-            continue
+    new_items = [item for item in items if item.url not in existing]
+
+    # 詳細ページは I/O 待ちが支配的なので並列で取得し、シートへの追記は直列で行う
+    print(f"Fetching {len(new_items)} detail pages...")
+    with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as executor:
+        detail_htmls = list(executor.map(fetch_detail_html, [item.url for item in new_items]))
+
+    rows = []
+    try:
+        for item, detail_html in zip(new_items, detail_htmls):
+            ### 変更点：詳細ページの取得に失敗した場合の処理を追加 ###
+            if not detail_html:
+                print(f"Skipping {item.name} because detail page could not be fetched.")
+                continue
+
+            detail = parse_detail(detail_html)
+            row = [
+                *item,
+                detail['age'],
+                detail['height'],
+                detail['cup'],
+                detail['face'],
+                detail['toy'],
+                detail['appear'],
+                detail['style'],
+                detail['job'],
+                detail['hobby'],
+                detail['favor'],
+                detail['seikantai'],
+                detail['genre'],
+            ]
+            rows.append(row)
+            print(f"Prepared: {item.name} - {item.url}")
+    finally:
+        # 途中で解析に失敗しても、それまでに組み立てた行は書き込んでおく
+        append_new_rows(ws, rows)
 
-        detail = parse_detail(detail_html)
-        row = [
-            item['name'],
-            item['image'],
-            item['url'],
-            item['comment'],
-            detail['age'],
-            detail['height'],
-            detail['cup'],
-            detail['face'],
-            detail['toy'],
-            detail['appear'],
-            detail['style'],
-            detail['job'],
-            detail['hobby'],
-            detail['favor'],
-            detail['seikantai'],
-            detail['genre'],
-        ]
- # ③ 追記時は必ず A1:P1 をテーブル起点に指定（←これが肝）
-        ws.append_row(
-            row,
-            value_input_option="USER_ENTERED",
-            table_range="A1:P1"   # ★ ここを指定することでW列起点問題を回避
-        )
-        
-        print(f"Added: {item['name']} - {item['url']}")
-        
-        ### 変更点：相手サーバーに配慮し、1.5秒待機する ###
-        time.sleep(1.5)
+    # 取得に失敗した詳細ページがあれば次回も一覧を処理し直せるよう、全件追記できた時だけ検証子を保存する
+    if len(rows) == len(new_items):
+        save_listing_meta(listing_resp)
 
 
 if __name__ == '__main__':